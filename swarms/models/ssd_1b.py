@@ -1,18 +1,101 @@
+import asyncio
 import concurrent.futures
+import functools
+import logging
 import os
+import shutil
+import string
+import threading
+import time
 import uuid
 from dataclasses import dataclass
 from io import BytesIO
 from typing import List
 
-import backoff
 import torch
 from cachetools import TTLCache
 from diffusers import StableDiffusionXLPipeline
+from diffusers.models.attention_processor import AttnProcessor2_0
 from PIL import Image
 from pydantic import field_validator
 from termcolor import colored
 
+logger = logging.getLogger(__name__)
+
+
+class _StepCache:
+    """
+    Wraps the UNet forward and reuses the last noise prediction on the
+    denoising steps in between full passes.
+
+    Only every ``interval``-th step runs the UNet, the others return the
+    previous prediction unchanged. This trades image quality for speed;
+    an interval of 1 passes every step straight through.
+    """
+
+    def __init__(self, forward):
+        self.forward = forward
+        self.reset()
+
+    def reset(self, interval: int = 1):
+        """Clear the cached step and set the interval for a run"""
+        self.interval = interval
+        self.step = 0
+        self.last_output = None
+
+    def __call__(self, sample, timestep, *args, **kwargs):
+        if self.interval <= 1:
+            return self.forward(sample, timestep, *args, **kwargs)
+
+        step = self.step
+        self.step += 1
+        if step % self.interval != 0 and self.last_output is not None:
+            return self.last_output
+
+        self.last_output = self.forward(sample, timestep, *args, **kwargs)
+        return self.last_output
+
+
+# Deletes every ascii character that isn't allowed in a generated file name
+_ALLOWED_NAME_CHARS = set(string.ascii_letters + string.digits + " _-")
+_NAME_TRANSLATION = str.maketrans(
+    "",
+    "",
+    "".join(
+        chr(code)
+        for code in range(128)
+        if chr(code) not in _ALLOWED_NAME_CHARS
+    ),
+)
+
+
+@functools.cache
+def _load_pipe(device: str, low_vram: bool = False):
+    """Load the SSD-1B pipeline once per device and memory mode"""
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        "segmind/SSD-1B",
+        torch_dtype=torch.float16,
+        use_safetensors=True,
+        variant="fp16",
+    )
+
+    if low_vram:
+        # Keep weights on the cpu and move each submodule in on demand
+        pipe.enable_sequential_cpu_offload(device=device)
+        try:
+            pipe.enable_xformers_memory_efficient_attention()
+        except ImportError:
+            pass
+    else:
+        pipe.to(device)
+
+    # Decode the latents in tiles to cap the VAE's peak memory
+    pipe.enable_vae_tiling()
+
+    # Every SSD1B on this device shares the pipe, serialize its calls
+    pipe._lock = threading.Lock()
+    return pipe
+
 
 @dataclass
 class SSD1B:
@@ -51,22 +134,103 @@ class SSD1B:
     image_format: str = "png"
     device: str = "cuda"
     dashboard: bool = False
+    compile: bool = True
+    low_vram: bool = False
+    cache_interval: int = 1
     cache = TTLCache(maxsize=100, ttl=3600)
-    pipe = StableDiffusionXLPipeline.from_pretrained(
-        "segmind/SSD-1B",
-        torch_dtype=torch.float16,
-        use_safetensors=True,
-        variant="fp16",
-    ).to(device)
 
     def __post_init__(self):
         """Post init method"""
+        self.pipe = _load_pipe(self.device, self.low_vram)
+        self._neg_embeds = None
 
         if self.img is not None:
             self.img = self.convert_to_bytesio(self.img)
 
         os.makedirs(self.save_path, exist_ok=True)
 
+        with self.pipe._lock:
+            # Compiled graphs don't survive the offload hooks moving weights
+            if self.compile and not self.low_vram:
+                self._compile_pipe()
+
+            # Installed after compiling so it wraps the compiled UNet
+            if self.cache_interval > 1 and not isinstance(
+                self.pipe.unet.forward, _StepCache
+            ):
+                self.pipe.unet.forward = _StepCache(self.pipe.unet.forward)
+
+    def _run_pipe(self, prompt, neg_prompt: str = None, **kwargs):
+        """
+        Run the shared pipeline while holding its lock
+
+        The scheduler and the UNet step cache are shared by every
+        instance on the device, so only one generation may run at a time.
+        """
+        batch_size = len(prompt) if isinstance(prompt, list) else 1
+        with self.pipe._lock:
+            # The step cache is shared, apply this instance's interval
+            step_cache = self.pipe.unet.forward
+            if isinstance(step_cache, _StepCache):
+                step_cache.reset(self.cache_interval)
+            return self.pipe(
+                prompt=prompt,
+                **self._negative_embeds(neg_prompt, batch_size),
+                **kwargs,
+            )
+
+    def _negative_embeds(
+        self, neg_prompt: str = None, batch_size: int = 1
+    ):
+        """Encode the negative prompt once and reuse the embeddings"""
+        # Only the latest prompt is kept, callers reuse a constant one
+        if self._neg_embeds is None or self._neg_embeds[0] != neg_prompt:
+            with torch.no_grad():
+                _, embeds, _, pooled = self.pipe.encode_prompt(
+                    prompt="",
+                    negative_prompt=neg_prompt,
+                    do_classifier_free_guidance=True,
+                )
+            self._neg_embeds = (neg_prompt, embeds, pooled)
+
+        _, embeds, pooled = self._neg_embeds
+        return {
+            "negative_prompt_embeds": embeds.expand(batch_size, -1, -1),
+            "negative_pooled_prompt_embeds": pooled.expand(batch_size, -1),
+        }
+
+    def _compile_pipe(self):
+        """Compile the UNet and VAE decoder and warm them up once"""
+        # The pipe is shared by every instance, only compile it once
+        if getattr(self.pipe, "_is_compiled", False):
+            return
+
+        # Compile the bare UNet, the step cache is reinstalled around it
+        if isinstance(self.pipe.unet.forward, _StepCache):
+            del self.pipe.unet.forward
+
+        self.pipe.unet.set_attn_processor(AttnProcessor2_0())
+        self.pipe.unet.to(memory_format=torch.channels_last)
+
+        unet, decode = self.pipe.unet, self.pipe.vae.decode
+        try:
+            self.pipe.unet = torch.compile(
+                unet, mode="reduce-overhead", fullgraph=False
+            )
+            self.pipe.vae.decode = torch.compile(
+                decode, mode="reduce-overhead", fullgraph=False
+            )
+
+            # Pay the compilation cost up front instead of on the first task
+            self.pipe("warmup", num_inference_steps=1)
+        except Exception:
+            # Leave the shared pipe usable in eager mode
+            self.pipe.unet = unet
+            self.pipe.vae.decode = decode
+            raise
+
+        self.pipe._is_compiled = True
+
     class Config:
         """Config class for the SSD1B model"""
 
@@ -93,14 +257,48 @@ class SSD1B:
     def convert_to_bytesio(self, img: str, format: str = "PNG"):
         """Convert the image to an bytes io object"""
         byte_stream = BytesIO()
-        img.save(byte_stream, format=format)
-        byte_array = byte_stream.getvalue()
-        return byte_array
+        # Fast png compression, the size difference is negligible
+        img.save(
+            byte_stream, format=format, optimize=False, compress_level=1
+        )
+        byte_stream.seek(0)
+        return byte_stream
+
+    def _with_backoff(
+        self,
+        func,
+        *args,
+        max_time: float = None,
+        max_tries: int = None,
+    ):
+        """
+        Call func, retrying with exponential backoff on any exception
 
-    @backoff.on_exception(
-        backoff.expo, Exception, max_time=max_time_seconds
-    )
-    def __call__(self, task: str, neg_prompt: str):
+        Gives up once max_tries attempts were made or the next retry would
+        start after max_time seconds.
+        """
+        deadline = None
+        if max_time is not None:
+            deadline = time.monotonic() + max_time
+
+        delay = 1.0
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                return func(*args)
+            except Exception:
+                if max_tries is not None and tries >= max_tries:
+                    raise
+                if (
+                    deadline is not None
+                    and time.monotonic() + delay > deadline
+                ):
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def __call__(self, task: str, neg_prompt: str = None):
         """
         Text to image conversion using the SSD1B API
 
@@ -126,18 +324,24 @@ class SSD1B:
             self.print_dashboard()
         if task in self.cache:
             return self.cache[task]
-        try:
-            img = self.pipe(prompt=task, neg_prompt=neg_prompt).images[0]
-
-            # Generate a unique filename for the image
-            img_name = f"{uuid.uuid4()}.{self.image_format}"
-            img_path = os.path.join(self.save_path, img_name)
+        return self._with_backoff(
+            self._generate,
+            task,
+            neg_prompt,
+            max_time=self.max_time_seconds,
+        )
 
-            # Save the image
-            img.save(img_path, self.image_format)
-            self.cache[task] = img_path
+    def _generate(self, task: str, neg_prompt: str = None):
+        """Generate and save a single image for the task"""
+        img = self._generate_image(task, neg_prompt)
+        img_path = self._save_image(img)
+        self.cache[task] = img_path
+        return img_path
 
-            return img_path
+    def _generate_image(self, task: str, neg_prompt: str = None):
+        """Run the pipeline for a single task and return the image"""
+        try:
+            return self._run_pipe(task, neg_prompt).images[0]
 
         except Exception as error:
             # Handling exceptions and printing the errors details
@@ -152,11 +356,52 @@ class SSD1B:
             )
             raise error
 
+    async def arun(self, task: str, neg_prompt: str = None):
+        """
+        Asynchronous version of __call__
+
+        The generation runs on the calling thread, which owns the compiled
+        pipe's cuda graphs, and blocks the event loop meanwhile. Only the
+        image save is moved to a worker thread, so it overlaps the
+        generation of the next call.
+        """
+        if self.dashboard:
+            self.print_dashboard()
+        if task in self.cache:
+            return self.cache[task]
+
+        img = self._with_backoff(
+            self._generate_image,
+            task,
+            neg_prompt,
+            max_time=self.max_time_seconds,
+        )
+        img_path = await asyncio.to_thread(self._save_image, img)
+        self.cache[task] = img_path
+        return img_path
+
+    def _save_image(self, img: Image) -> str:
+        """Encode the image and write it to a uniquely named file"""
+        img_name = f"{uuid.uuid4()}.{self.image_format}"
+        img_path = os.path.join(self.save_path, img_name)
+
+        byte_stream = self.convert_to_bytesio(img, self.image_format)
+        with open(img_path, "wb") as file:
+            shutil.copyfileobj(byte_stream, file)
+
+        return img_path
+
     def _generate_image_name(self, task: str):
         """Generate a sanitized file name based on the task"""
-        sanitized_task = "".join(
-            char for char in task if char.isalnum() or char in " _ -"
-        ).rstrip()
+        sanitized_task = task.translate(_NAME_TRANSLATION)
+        if not sanitized_task.isascii():
+            # The table only covers ascii, drop non-ascii symbols by hand
+            sanitized_task = "".join(
+                char
+                for char in sanitized_task
+                if char.isascii() or char.isalnum()
+            )
+        sanitized_task = sanitized_task.rstrip()
         return f"{sanitized_task}.{self.image_format}"
 
     def _download_image(self, img: Image, filename: str):
@@ -192,15 +437,25 @@ class SSD1B:
         )
 
     def process_batch_concurrently(
-        self, tasks: List[str], max_workers: int = 5
+        self,
+        tasks: List[str],
+        max_workers: int = 5,
+        batch_size: int = 4,
+        neg_prompt: str = None,
     ):
         """
 
         Process a batch of tasks concurrently
 
+        Prompts are sent to the pipeline in chunks of ``batch_size`` so the
+        UNet denoises them together on the GPU; only the image saves are
+        dispatched to a thread pool.
+
         Args:
         tasks (List[str]): A list of tasks to be processed
-        max_workers (int): The maximum number of workers to use for the concurrent processing
+        max_workers (int): The maximum number of workers used to save the images
+        batch_size (int): The number of prompts sent to the pipeline per call
+        neg_prompt (str): The negative prompt applied to every task
 
         Returns:
         --------
@@ -214,47 +469,116 @@ class SSD1B:
         >>> print(results)
 
         """
+        results, pending = self._split_cached(tasks)
+        saves = []
+
         with concurrent.futures.ThreadPoolExecutor(
             max_workers=max_workers
         ) as executor:
-            future_to_task = {
-                executor.submit(self, task): task for task in tasks
-            }
-            results = []
-            for future in concurrent.futures.as_completed(future_to_task):
-                task = future_to_task[future]
-                try:
-                    img = future.result()
-                    results.append(img)
-
-                    print(f"Task {task} completed: {img}")
-                except Exception as error:
-                    print(
-                        colored(
-                            (
-                                f"Error running SSD1B: {error} try"
-                                " optimizing your api key and or try"
-                                " again"
-                            ),
-                            "red",
-                        )
-                    )
-                    print(
-                        colored(
-                            (
-                                "Error running SSD1B:"
-                                f" {error.http_status}"
-                            ),
-                            "red",
-                        )
-                    )
-                    print(
-                        colored(
-                            f"Error running SSD1B: {error.error}",
-                            "red",
+            try:
+                for chunk in self._chunks(pending, batch_size):
+                    images = self._generate_chunk(tasks, chunk, neg_prompt)
+
+                    # Save in the background and move on to the next chunk
+                    for index, img in zip(chunk, images):
+                        save = executor.submit(self._save_image, img)
+                        saves.append((index, save))
+            finally:
+                # Keep the images that were saved even if a chunk failed
+                concurrent.futures.wait([save for _, save in saves])
+                self._collect_saves(tasks, results, saves)
+
+        # Surface the first failed save
+        for _, save in saves:
+            save.result()
+
+        return results
+
+    async def aprocess_batch(
+        self,
+        tasks: List[str],
+        max_workers: int = 5,
+        batch_size: int = 4,
+        neg_prompt: str = None,
+    ):
+        """
+        Asynchronous version of process_batch_concurrently
+
+        Like arun, the chunks are generated on the calling thread and only
+        the image saves run on the thread pool.
+        """
+        results, pending = self._split_cached(tasks)
+        loop = asyncio.get_running_loop()
+        saves = []
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        ) as executor:
+            try:
+                for chunk in self._chunks(pending, batch_size):
+                    images = self._generate_chunk(tasks, chunk, neg_prompt)
+
+                    # Save in the background and move on to the next chunk
+                    for index, img in zip(chunk, images):
+                        save = loop.run_in_executor(
+                            executor, self._save_image, img
                         )
-                    )
-                    raise error
+                        saves.append((index, save))
+            finally:
+                # Keep the images that were saved even if a chunk failed
+                if saves:
+                    await asyncio.wait([save for _, save in saves])
+                self._collect_saves(tasks, results, saves)
+
+        # Surface the first failed save
+        for _, save in saves:
+            save.result()
+
+        return results
+
+    def _split_cached(self, tasks: List[str]):
+        """Resolve cached tasks, return the results and pending indexes"""
+        results = [None] * len(tasks)
+        pending = []
+        for index, task in enumerate(tasks):
+            if task in self.cache:
+                results[index] = self.cache[task]
+            else:
+                pending.append(index)
+        return results, pending
+
+    @staticmethod
+    def _chunks(pending: List[int], batch_size: int):
+        """Split the pending task indexes into pipeline sized chunks"""
+        chunk_size = max(1, batch_size)
+        for start in range(0, len(pending), chunk_size):
+            yield pending[start : start + chunk_size]
+
+    def _generate_chunk(
+        self, tasks: List[str], chunk: List[int], neg_prompt
+    ):
+        """Generate the images for one chunk of task indexes"""
+        prompts = [tasks[index] for index in chunk]
+        try:
+            output = self._run_pipe(
+                prompts, neg_prompt, num_images_per_prompt=1
+            )
+        except Exception:
+            logger.exception("SSD1B tasks %s failed", prompts)
+            raise
+        return output.images
+
+    def _collect_saves(self, tasks: List[str], results: list, saves: list):
+        """Cache and record the paths of the saves that succeeded"""
+        for index, save in saves:
+            if save.exception() is not None:
+                continue
+            img_path = save.result()
+            task = tasks[index]
+            self.cache[task] = img_path
+            results[index] = img_path
+
+            print(f"Task {task} completed: {img_path}")
 
     def _generate_uuid(self):
         """Generate a uuid"""
@@ -268,7 +592,8 @@ class SSD1B:
         """Str method for the SSD1B class"""
         return f"SSD1B(image_url={self.image_url})"
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=max_retries)
     def rate_limited_call(self, task: str):
         """Rate limited call to the SSD1B API"""
-        return self.__call__(task)
+        return self._with_backoff(
+            self.__call__, task, max_tries=self.max_retries
+        )
@@ -1,6 +1,7 @@
 import json
 from typing import Any, Dict, List, Union
 
+import torch
 from termcolor import cprint
 from transformers import PreTrainedModel, PreTrainedTokenizer
 from pydantic import BaseModel
@@ -165,7 +166,10 @@ class Jsonformer:
             input_tensor = self.tokenizer.encode(
                 prompt, return_tensors="pt"
             )
-            output = self.model.forward(input_tensor.to(self.model.device))
+            with torch.inference_mode():
+                output = self.model.forward(
+                    input_tensor.to(self.model.device)
+                )
             logits = output.logits[0, -1]
 
             # todo: this assumes that "true" and "false" are both tokenized to a single token
@@ -325,21 +329,21 @@ class Jsonformer:
                 input_tensor = self.tokenizer.encode(
                     input_prompt, return_tensors="pt"
                 )
-                output = self.model.forward(
-                    input_tensor.to(self.model.device)
-                )
+                with torch.inference_mode():
+                    output = self.model.forward(
+                        input_tensor.to(self.model.device)
+                    )
                 logits = output.logits[0, -1]
 
-                top_indices = logits.topk(30).indices
-                sorted_token_ids = top_indices[
-                    logits[top_indices].argsort(descending=True)
-                ]
+                # topk already returns the ids sorted by descending logit
+                sorted_token_ids = logits.topk(30).indices
 
                 found_comma = False
                 found_close_bracket = False
 
-                for token_id in sorted_token_ids:
-                    decoded_token = self.tokenizer.decode(token_id)
+                # Copy the ids to the host once, decode them lazily
+                for token_id in sorted_token_ids.cpu().tolist():
+                    decoded_token = self.tokenizer.decode([token_id])
                     if "," in decoded_token:
                         found_comma = True
                         break
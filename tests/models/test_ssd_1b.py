@@ -1,7 +1,15 @@
+import asyncio
+import os
+import threading
+from io import BytesIO
+from types import SimpleNamespace
+
 import pytest
+import torch
 from PIL import Image
 
-from swarms.models.ssd_1b import SSD1B
+from swarms.models import ssd_1b
+from swarms.models.ssd_1b import SSD1B, _StepCache
 
 
 # Create fixtures if needed
@@ -10,6 +18,41 @@ def ssd1b_model():
     return SSD1B()
 
 
+class StubPipe:
+    """Stands in for the diffusers pipeline, records every call"""
+
+    def __init__(self, fail_on_call=None):
+        self._lock = threading.Lock()
+        self.unet = SimpleNamespace(forward=None)
+        self.fail_on_call = fail_on_call
+        self.calls = []
+        self.encoded = []
+
+    def encode_prompt(self, prompt, negative_prompt, **kwargs):
+        self.encoded.append(negative_prompt)
+        return None, torch.zeros(1, 77, 8), None, torch.zeros(1, 8)
+
+    def __call__(self, prompt, **kwargs):
+        self.calls.append((prompt, kwargs))
+        if len(self.calls) == self.fail_on_call:
+            raise RuntimeError("pipe failed")
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        return SimpleNamespace(
+            images=[Image.new("RGB", (4, 4)) for _ in prompts]
+        )
+
+
+@pytest.fixture
+def stub_model(tmp_path):
+    # Bypass __post_init__ so the real pipeline isn't loaded
+    model = SSD1B.__new__(SSD1B)
+    model.pipe = StubPipe()
+    model.cache = {}
+    model.save_path = str(tmp_path)
+    model._neg_embeds = None
+    return model
+
+
 # Basic tests for model initialization and method call
 def test_ssd1b_model_initialization(ssd1b_model):
     assert ssd1b_model is not None
@@ -130,6 +173,27 @@ def test_ssd1b_generate_image_name(ssd1b_model):
     assert len(img_name) > 0
 
 
+@pytest.mark.parametrize(
+    "task",
+    [
+        "A painting of a dog",
+        "A painting/of a dog? _-x! ",
+        "A \u201cdog\u201d \u2014 caf\u00e9 \U0001f436 ",
+        "",
+    ],
+)
+def test_ssd1b_generate_image_name_sanitizes(task):
+    # Bypass __post_init__ so the pipeline isn't loaded
+    model = SSD1B.__new__(SSD1B)
+    expected = "".join(
+        char for char in task if char.isalnum() or char in " _ -"
+    ).rstrip()
+    assert (
+        model._generate_image_name(task)
+        == f"{expected}.{model.image_format}"
+    )
+
+
 def test_ssd1b_set_width_height(ssd1b_model, mocker):
     img = mocker.MagicMock()
     width, height = 800, 600
@@ -147,7 +211,8 @@ def test_ssd1b_convert_to_bytesio(ssd1b_model, mocker):
     img = mocker.MagicMock()
     img_format = "PNG"
     result = ssd1b_model.convert_to_bytesio(img, img_format)
-    assert isinstance(result, bytes)
+    assert isinstance(result, BytesIO)
+    assert result.tell() == 0
 
 
 def test_ssd1b_save_image(ssd1b_model, mocker, tmp_path):
@@ -163,3 +228,234 @@ def test_ssd1b_repr_str(ssd1b_model):
     image_url = ssd1b_model(task)
     assert repr(ssd1b_model) == f"SSD1B(image_url={image_url})"
     assert str(ssd1b_model) == f"SSD1B(image_url={image_url})"
+
+
+def _stub_step_cache():
+    calls = []
+
+    def forward(sample, timestep):
+        calls.append(timestep)
+        return f"noise-{timestep}"
+
+    return _StepCache(forward), calls
+
+
+def test_step_cache_interval_one_passes_through():
+    step_cache, calls = _stub_step_cache()
+    step_cache.reset()
+    outputs = [step_cache(None, t) for t in range(4)]
+    assert calls == [0, 1, 2, 3]
+    assert outputs == ["noise-0", "noise-1", "noise-2", "noise-3"]
+    assert step_cache.last_output is None
+
+
+def test_step_cache_reuses_between_intervals():
+    step_cache, calls = _stub_step_cache()
+    step_cache.reset(interval=3)
+    outputs = [step_cache(None, t) for t in range(7)]
+    assert calls == [0, 3, 6]
+    assert outputs == [
+        "noise-0",
+        "noise-0",
+        "noise-0",
+        "noise-3",
+        "noise-3",
+        "noise-3",
+        "noise-6",
+    ]
+
+
+def test_step_cache_reset_clears_state():
+    step_cache, calls = _stub_step_cache()
+    step_cache.reset(interval=3)
+    step_cache(None, 0)
+    step_cache(None, 1)
+
+    step_cache.reset(interval=3)
+    assert step_cache.step == 0
+    assert step_cache.last_output is None
+
+    assert step_cache(None, 5) == "noise-5"
+    assert calls == [0, 5]
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    clock = {"now": 0.0, "sleeps": []}
+
+    def sleep(delay):
+        clock["sleeps"].append(delay)
+        clock["now"] += delay
+
+    monkeypatch.setattr(ssd_1b.time, "sleep", sleep)
+    monkeypatch.setattr(ssd_1b.time, "monotonic", lambda: clock["now"])
+    return clock
+
+
+def _failing(errors):
+    calls = []
+
+    def func():
+        calls.append(len(calls))
+        raise errors[len(calls) - 1]
+
+    return func, calls
+
+
+def test_ssd1b_with_backoff_honours_max_tries(fake_clock):
+    model = SSD1B.__new__(SSD1B)
+    errors = [ValueError("first"), ValueError("second"), KeyError("last")]
+    func, calls = _failing(errors)
+
+    with pytest.raises(KeyError, match="last"):
+        model._with_backoff(func, max_tries=3)
+    assert len(calls) == 3
+    assert fake_clock["sleeps"] == [1.0, 2.0]
+
+
+def test_ssd1b_with_backoff_honours_deadline(fake_clock):
+    model = SSD1B.__new__(SSD1B)
+    errors = [ValueError(str(i)) for i in range(10)]
+    func, calls = _failing(errors)
+
+    # Sleeps 1 + 2 fit in 5 seconds, the next 4 second sleep doesn't
+    with pytest.raises(ValueError, match="2"):
+        model._with_backoff(func, max_time=5)
+    assert len(calls) == 3
+    assert fake_clock["sleeps"] == [1.0, 2.0]
+
+
+def test_ssd1b_with_backoff_returns_after_retry(fake_clock):
+    model = SSD1B.__new__(SSD1B)
+    attempts = []
+
+    def func(value):
+        attempts.append(value)
+        if len(attempts) < 2:
+            raise ValueError("flaky")
+        return value
+
+    assert model._with_backoff(func, "ok", max_tries=3) == "ok"
+    assert attempts == ["ok", "ok"]
+
+
+def test_ssd1b_negative_embeds_expanded_and_encoded_once(stub_model):
+    stub_model._run_pipe(["a dog", "a cat"], "ugly")
+    stub_model._run_pipe(["a tree"], "ugly")
+
+    assert stub_model.pipe.encoded == ["ugly"]
+    for (prompt, kwargs), batch_size in zip(stub_model.pipe.calls, [2, 1]):
+        assert "negative_prompt" not in kwargs
+        embeds = kwargs["negative_prompt_embeds"]
+        pooled = kwargs["negative_pooled_prompt_embeds"]
+        assert tuple(embeds.shape) == (batch_size, 77, 8)
+        assert tuple(pooled.shape) == (batch_size, 8)
+
+
+def test_ssd1b_negative_embeds_keeps_latest_prompt(stub_model):
+    stub_model._run_pipe("a dog", "ugly")
+    stub_model._run_pipe("a dog", "blurry")
+    stub_model._run_pipe("a dog", "blurry")
+
+    assert stub_model.pipe.encoded == ["ugly", "blurry"]
+    assert stub_model._neg_embeds[0] == "blurry"
+
+
+def test_ssd1b_batch_results_in_task_order(stub_model):
+    tasks = ["a dog", "a cat", "a tree", "a house", "a boat"]
+    results = stub_model.process_batch_concurrently(tasks, batch_size=2)
+
+    assert [stub_model.cache[task] for task in tasks] == results
+    assert len(set(results)) == len(tasks)
+    assert all(os.path.exists(path) for path in results)
+
+
+def test_ssd1b_batch_chunk_sizes(stub_model):
+    tasks = ["a dog", "a cat", "a tree", "a house", "a boat"]
+    stub_model.process_batch_concurrently(tasks, batch_size=2)
+
+    prompts = [prompt for prompt, _ in stub_model.pipe.calls]
+    assert prompts == [
+        ["a dog", "a cat"],
+        ["a tree", "a house"],
+        ["a boat"],
+    ]
+
+
+def test_ssd1b_batch_skips_cached_tasks(stub_model):
+    stub_model.cache["a cat"] = "cached.png"
+    results = stub_model.process_batch_concurrently(
+        ["a dog", "a cat", "a tree"], batch_size=4
+    )
+
+    assert results[1] == "cached.png"
+    assert [prompt for prompt, _ in stub_model.pipe.calls] == [
+        ["a dog", "a tree"]
+    ]
+
+
+def test_ssd1b_batch_caches_saved_images_on_failure(stub_model):
+    stub_model.pipe.fail_on_call = 2
+    tasks = ["a dog", "a cat", "a tree", "a house"]
+
+    with pytest.raises(RuntimeError, match="pipe failed"):
+        stub_model.process_batch_concurrently(tasks, batch_size=2)
+
+    assert set(stub_model.cache) == {"a dog", "a cat"}
+    assert all(os.path.exists(path) for path in stub_model.cache.values())
+
+
+class OverlapPipe(StubPipe):
+    """Blocks the second generation until the first save has started"""
+
+    def __init__(self):
+        super().__init__()
+        self.save_started = threading.Event()
+        self.threads = []
+        self.overlapped = []
+
+    def __call__(self, prompt, **kwargs):
+        self.threads.append(threading.get_ident())
+        if self.calls:
+            self.overlapped.append(self.save_started.wait(timeout=5))
+        return super().__call__(prompt, **kwargs)
+
+
+@pytest.fixture
+def overlap_model(stub_model):
+    stub_model.pipe = OverlapPipe()
+    save_image = stub_model._save_image
+
+    def _save_image(img):
+        stub_model.pipe.save_started.set()
+        return save_image(img)
+
+    stub_model._save_image = _save_image
+    return stub_model
+
+
+def test_ssd1b_arun_overlaps_save_with_generation(overlap_model):
+    async def main():
+        return await asyncio.gather(
+            overlap_model.arun("a dog"), overlap_model.arun("a cat")
+        )
+
+    results = asyncio.run(main())
+
+    assert all(os.path.exists(path) for path in results)
+    assert overlap_model.pipe.overlapped == [True]
+    # Generation stays on the thread that runs the event loop
+    assert overlap_model.pipe.threads == [threading.get_ident()] * 2
+
+
+def test_ssd1b_aprocess_batch_overlaps_save_with_generation(
+    overlap_model,
+):
+    tasks = ["a dog", "a cat", "a tree"]
+    results = asyncio.run(
+        overlap_model.aprocess_batch(tasks, batch_size=2)
+    )
+
+    assert [overlap_model.cache[task] for task in tasks] == results
+    assert overlap_model.pipe.overlapped == [True]
+    assert overlap_model.pipe.threads == [threading.get_ident()] * 2